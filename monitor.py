@@ -5,14 +5,76 @@ from getpass import getpass
 from netmiko import ConnectHandler
 from tabulate import tabulate
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import errno
 import re
 import os
 import socket
+import subprocess
+import sys
+import threading
+import time
+
+from cachetools import TTLCache
+
+try:
+    from icmplib import AsyncSocket, ICMPv4Socket, ICMPRequest, ICMPLibError, ICMPError, PID
+except ImportError:
+    ICMPv4Socket = None
 
 from config import DEVICE_NAME, DEVICE_IP, DEVICE_TYPE, INTERFACES
 
-USERNAME = input("Username: ")
-PASSWORD = getpass("Password: ")
+# * 4        0050.569f.0c60    dynamic     ~~~      F    F  Po6
+_MAC_RE = re.compile(r"^\*[ \t](?P<vlan>\d+)[ \t]+(?P<mac_address>[0-9a-f\.]{14})[ \t].*[ \t](?P<port>\S+)[ \t\r]*$", re.MULTILINE)
+# 10.25.5.37      00:08:31  0050.569f.0c60  Vlan4
+_ARP_RE = re.compile(r"^(?P<ip_address>\d{1,3}(?:\.\d{1,3}){3})[ \t]+(?P<age>\d{2}:\d{2}:\d{2})[ \t]+(?P<mac_address>[0-9a-f\.]{14})", re.MULTILINE)
+# port-channel6, Eth1/1
+_INTERFACE_RE = re.compile(r"^(?P<type>[a-z\-]+)\s*(?P<id>\d.*)$")
+
+SSH_SESSIONS = 2
+DNS_WORKERS = 32
+PING_INTERVAL = 1
+SAVE_INTERVAL = 5.0
+RESOLVE_INTERVAL = 300.0
+
+# Receive errors caused by a single oversized packet, which can be skipped.
+_MESSAGE_TOO_LONG_ERRNOS = {errno.EMSGSIZE, getattr(errno, 'WSAEMSGSIZE', errno.EMSGSIZE)}
+
+# Reverse DNS names by IP address, re-resolved after an hour when the monitor
+# refreshes names. Addresses without a name are retried sooner, after five minutes.
+_dns_cache = TTLCache(maxsize=4096, ttl=3600)
+_dns_negative_cache = TTLCache(maxsize=4096, ttl=300)
+_dns_cache_lock = threading.Lock()
+
+
+def reverse_dns(ip_address):
+    """ Looks up the DNS name of an IP address, caching the result.
+    Args:
+        ip_address:
+            A str, the IP address to resolve.
+    Returns:
+        A str, or None if the address has no DNS name.
+    """
+    with _dns_cache_lock:
+        if ip_address in _dns_cache:
+            return _dns_cache[ip_address]
+        if ip_address in _dns_negative_cache:
+            return None
+
+    try:
+        # NI_NAMEREQD makes a missing PTR record an error instead of returning the address.
+        name = socket.getnameinfo((ip_address, 0), socket.NI_NAMEREQD)[0]
+    except OSError:
+        with _dns_cache_lock:
+            _dns_negative_cache[ip_address] = None
+        return None
+
+    with _dns_cache_lock:
+        _dns_cache[ip_address] = name
+
+    return name
+
 
 class Device:
     """ The Cisco device to manage """
@@ -22,75 +84,164 @@ class Device:
         self.username = username
         self.password = password
         self.device_type = device_type
-        self.ssh = None
+        self.sessions = []
         self.nodes = []
 
     def __str__(self):
         return self.name
 
-    def connect(self):
-        """ Log into the device """
+    def connect(self, sessions=1):
+        """ Log into the device
+        Args:
+            sessions:
+                An int, how many SSH sessions to open in parallel for sending commands concurrently.
+        """
         cisco_router = {
             'device_type': self.device_type,
             'host': self.ip,
             'username': self.username,
             'password': self.password
         }
-        self.ssh = ConnectHandler(**cisco_router)
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            futures = [executor.submit(ConnectHandler, **cisco_router) for _ in range(sessions)]
+
+        # Don't leave the successful logins open if any of them failed.
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            for future in futures:
+                if future.exception() is None:
+                    future.result().disconnect()
+            raise errors[0]
+
+        self.sessions = [future.result() for future in futures]
 
     def disconnect(self):
         """ Log out of the device """
-        self.ssh.disconnect()
-        self.ssh = None
+        for ssh in self.sessions:
+            ssh.disconnect()
+        self.sessions = []
 
-    def create_attached_nodes(self, interface):
-        """ Gets the MAC Addresses connected to the interface.
+    def send_commands(self, commands, **kwargs):
+        """ Sends the commands concurrently, spread round-robin over the open SSH sessions.
+
+        Each session sends its share of the commands one after another, so with a
+        single session the commands are sent sequentially.
         Args:
-            interface:
-                A str, the name identifying which interface to get the mac-address table of.
+            commands:
+                A list of str, the commands to send.
+            kwargs:
+                Passed through to netmiko's send_command.
         Returns:
-            A list of str.
+            A list, the output of each command in the same order.
         """
-        def get_vlan_and_mac_addresses(interface):
-            # * 4        0050.569f.0c60    dynamic     ~~~      F    F  Po6
-            match_line = re.compile(r"^\*\s(?P<vlan>\d+)\s+(?P<mac_address>[0-9a-f\.]{14})")
+        sessions = self.sessions[:len(commands)]
+        outputs = [None] * len(commands)
+
+        def send(session_index):
+            for index in range(session_index, len(commands), len(sessions)):
+                outputs[index] = sessions[session_index].send_command(commands[index], **kwargs)
+
+        with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+            list(executor.map(send, range(len(sessions))))
+
+        return outputs
+
+    def create_attached_nodes(self, interfaces):
+        """ Creates a node for each MAC Address connected to the interfaces.
+
+        Fetches the whole MAC address table and ARP table once, concurrently over
+        separate SSH sessions and parsed by netmiko's TextFSM templates, then
+        matches them up locally rather than querying the device per interface and
+        per MAC Address.
+        Args:
+            interfaces:
+                A list of str, the names identifying which interfaces to get the attached nodes of.
+        """
+        def get_field(entry, *names):
+            # Field names differ between ntc-templates releases and platforms.
+            for name in names:
+                if entry.get(name):
+                    return entry[name]
+
+        def parse_mac_address_table(output):
+            # Netmiko returns the raw output when there is no TextFSM template for the device.
+            if isinstance(output, str):
+                return [match.group('vlan', 'mac_address', 'port') for match in _MAC_RE.finditer(output)]
+
+            mac_address_table = []
+
+            for entry in output:
+                vlan = get_field(entry, 'vlan_id', 'vlan')
+                mac_address = get_field(entry, 'mac_address', 'destination_address', 'mac')
+                port = get_field(entry, 'ports', 'destination_port')
+
+                if isinstance(port, list):
+                    port = port[0]
+
+                if vlan and mac_address and port:
+                    mac_address_table.append((vlan, mac_address, port))
+
+            return mac_address_table
+
+        def parse_arp_table(output):
+            arp_table = {}
+
+            if isinstance(output, str):
+                for match in _ARP_RE.finditer(output):
+                    arp_table.setdefault(match.group('mac_address'), match.group('ip_address'))
+
+                return arp_table
+
+            for entry in output:
+                ip_address = get_field(entry, 'ip_address', 'address')
+                mac_address = get_field(entry, 'mac_address', 'mac')
 
-            output = self.ssh.send_command(f"show mac address-table interface {interface}")
+                if ip_address and mac_address:
+                    arp_table.setdefault(mac_address, ip_address)
 
-            vlan_and_mac_addresses = []
+            return arp_table
 
-            for line in output.split("\n"):
-                match = match_line.match(line)
+        def normalize_interface(name):
+            # Splits e.g. "Eth1/1" into ("eth", "1/1"), or (name, None) if it doesn't parse.
+            match = _INTERFACE_RE.match(name.lower())
 
-                if match:
-                    groups = match.groupdict()
-                    vlan = groups['vlan']
-                    mac_address = groups['mac_address']
-                    vlan_and_mac_addresses.append((vlan, mac_address))
+            if not match:
+                return name.lower(), None
 
-            return vlan_and_mac_addresses
+            return match.group('type', 'id')
 
-        def get_ip_address(mac_address):
-            # 10.25.5.37      00:08:31  0050.569f.0c60  Vlan4
-            match_line = re.compile(r"^(?P<ip_address>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s+(?P<age>\d{2}:\d{2}:\d{2})\s+")
+        def is_same_interface(port, interface):
+            # The device abbreviates port names (Po6, Eth1/1), which may be configured
+            # in full (port-channel6, Ethernet1/1) or abbreviated differently.
+            port_type, port_id = port
+            interface_type, interface_id = interface
 
-            output = self.ssh.send_command(f"show ip arp | include {mac_address}")
-            
-            match = match_line.match(output)
+            if port_id is None or interface_id is None:
+                return port == interface
 
-            if match:
-                groups = match.groupdict()
-                ip_address = groups['ip_address']
-                
-                return ip_address
+            return port_id == interface_id and (port_type.startswith(interface_type) or interface_type.startswith(port_type))
 
-        vlan_and_mac_addresses = get_vlan_and_mac_addresses(interface)
-        
-        for vlan, mac_address in vlan_and_mac_addresses:
-            ip_address = get_ip_address(mac_address)
-            node = Node(mac_address, ip_address, interface, vlan)
-            print(f"{node.interface}\t{node.vlan}\t{node.mac_address}\t{node.ip_address}")
-            self.nodes.append(node)
+        mac_address_table_output, arp_table_output = self.send_commands(
+            ["show mac address-table", "show ip arp"],
+            use_textfsm=True
+        )
+        mac_address_table = parse_mac_address_table(mac_address_table_output)
+        arp_table = parse_arp_table(arp_table_output)
+
+        # Normalize every port and interface name once, rather than per comparison.
+        ports = [normalize_interface(port) for _, _, port in mac_address_table]
+
+        for interface in interfaces:
+            normalized_interface = normalize_interface(interface)
+
+            for (vlan, mac_address, _), port in zip(mac_address_table, ports):
+                if not is_same_interface(port, normalized_interface):
+                    continue
+
+                ip_address = arp_table.get(mac_address)
+                node = Node(mac_address, ip_address, interface, vlan)
+                print(f"{node.interface}\t{node.vlan}\t{node.mac_address}\t{node.ip_address}")
+                self.nodes.append(node)
 
 
 class Node:
@@ -104,6 +255,7 @@ class Node:
         self.last_ping_successful = False
         self.successful_pings = 0
         self.failed_pings = 0
+        self._rate = 0.0
 
     def __str__(self):
         if self.name != None:
@@ -112,37 +264,55 @@ class Node:
             return self.ip_address
 
     def ping(self):
-        """ Pings the IP address """
-        command = f"ping -n 1 -w 2 {self.ip_address} >> output.txt"
+        """ Pings the IP address with the system ping command """
+        command = ["ping", "-n", "1", "-w", "2", self.ip_address]
+
+        try:
+            response = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False).returncode
+        except OSError:
+            # The ping command could not be started.
+            response = None
 
-        response = os.system(command)
-        if response == 0:
+        self.record_ping(response == 0)
+
+    def record_ping(self, successful):
+        """ Records the result of a ping to the node.
+        Args:
+            successful:
+                A bool, whether the node replied to the ping.
+        """
+        if successful:
             self.last_ping_successful = True
             self.successful_pings += 1
         else:
             self.last_ping_successful = False
             self.failed_pings += 1
 
+        self._rate = self.successful_pings / (self.successful_pings + self.failed_pings) * 100
+
     def nslookup(self):
         """ Sets the DNS name for the node """
-        try:
-            self.name = socket.gethostbyaddr(self.ip_address)[0]
-        except:
-            self.name = None
+        self.name = reverse_dns(self.ip_address)
 
     @property
     def response_rate(self):
-        if self.successful_pings == 0:
-            return "0%"
-        else:      
-            return f"{round(self.successful_pings / (self.successful_pings + self.failed_pings) * 100, 1)}%"
+        """ The percentage of pings answered, kept up to date by record_ping """
+        return f"{self._rate:.1f}%"
 
     
 class Table:
     """ Table for monitored node information. """
     def __init__(self):
-        self.headers = ["Interface", "VLAN", "MAC Address", "IP Address", "Name", "Response Rate"]
-        self.rows = []
+        self.headers = ["Interface", "VLAN", "MAC Address", "IP Address", "Name", "Response Rate", "Last Ping"]
+        # Interface, VLAN, MAC Address and IP Address never change after collection,
+        # so they are kept apart from the name and response rate updated each round.
+        self._static = []
+        self._dynamic = []
+
+    @property
+    def rows(self):
+        """ The table's rows, generated from the static and dynamic node information. """
+        return ((*static, *dynamic) for static, dynamic in zip(self._static, self._dynamic))
 
     def pre_populate_table(self, nodes):
         """ Adds node information to table's rows before monitoring. 
@@ -150,15 +320,18 @@ class Table:
             nodes:
                 An list, containing the node objects.
         """
+        def intern(value):
+            # Share one copy of repeated strings such as interface names and VLAN ids.
+            return sys.intern(value) if isinstance(value, str) else value
+
         for node in nodes:
-            self.rows.append([
-                node.interface, 
-                node.vlan, 
-                node.mac_address, 
-                node.ip_address, 
-                node.name, 
-                node.response_rate
-            ])
+            self._static.append((
+                intern(node.interface),
+                intern(node.vlan),
+                intern(node.mac_address),
+                intern(node.ip_address)
+            ))
+            self._dynamic.append([node.name, node.response_rate, node.last_ping_successful])
 
     def update_row(self, node, index):
         """ Updates the row in the table with the node's current information. 
@@ -168,68 +341,253 @@ class Table:
             index:
                 An int, the node index for the table's rows and for the device's node list.
         """
-        self.rows[index] = [
-            node.interface, 
-            node.vlan, 
-            node.mac_address, 
-            node.ip_address, 
-            node.name, 
-            node.response_rate
-        ]
-
-    def save(self, start, end):
+        row = self._dynamic[index]
+        row[0] = node.name
+        row[1] = node.response_rate
+        row[2] = node.last_ping_successful
+
+    def render(self):
+        """ Renders the table as text.
+        Returns:
+            A str.
+        """
+        # No cell should be parsed as a number, so skip tabulate's per-cell number parsing.
+        return tabulate(self.rows, self.headers, disable_numparse=True)
+
+    def save(self, start, end, rendered):
         """ Saves the table to a text file. 
         Args:
             start:
                 A datetime object, when monitoring started.
             end:
                 A datetime object, when monitoring finished.
+            rendered:
+                A str, the table as returned by render.
+        Returns:
+            A bool, False if the file could not be replaced and the save should be retried.
         """
-        with open("output_table.txt", "w") as f:
+        # Write to a temporary file and swap it in so readers never see a partial table.
+        with open("output_table.txt.tmp", "w") as f:
             f.writelines(f"{start} - {end}")
             f.writelines("\n\n")
-            f.writelines(tabulate(self.rows, self.headers))
+            f.writelines(rendered)
+
+        try:
+            os.replace("output_table.txt.tmp", "output_table.txt")
+        except OSError:
+            # On Windows the file can't be replaced while another process has it open.
+            return False
+
+        return True
+
+
+class Pinger:
+    """ Pings many hosts at once over one shared ICMP socket """
+    def __init__(self, timeout=2):
+        """ Opens the ICMP socket, raising ICMPLibError if it is not permitted.
+        Args:
+            timeout:
+                An int, the seconds to wait for replies to each batch of pings.
+        """
+        self.sock = AsyncSocket(ICMPv4Socket(privileged=False))
+        self.timeout = timeout
+        self.sequence = 0
+
+    def close(self):
+        """ Closes the ICMP socket """
+        self.sock.close()
+
+    async def ping(self, ip_addresses):
+        """ Sends one echo request to each IP address, then waits for the replies.
+
+        Replies are matched to requests by their identifier and sequence number, as
+        every request goes out over the same socket.
+        Args:
+            ip_addresses:
+                A list of str, the IP addresses to ping.
+        Returns:
+            A set of str, the IP addresses that replied.
+        """
+        pending = {}
+
+        for ip_address in ip_addresses:
+            self.sequence = (self.sequence + 1) & 0xffff
+            request = ICMPRequest(destination=ip_address, id=PID, sequence=self.sequence)
+
+            try:
+                self.sock.send(request)
+            except ICMPLibError:
+                # e.g. no route to the host, counted as a failed ping.
+                continue
+
+            # The kernel may replace the identifier, which send updates the request with.
+            pending[(request.id, request.sequence)] = ip_address
+
+        replied = set()
+        time_limit = time.monotonic() + self.timeout
+
+        while pending:
+            remaining = time_limit - time.monotonic()
+            if remaining <= 0:
+                break
+
+            try:
+                reply = await self.sock.receive(timeout=remaining)
+            except ICMPLibError as error:
+                # icmplib wraps the OSError, which is kept as the exception's context.
+                if getattr(error.__context__, 'errno', None) in _MESSAGE_TOO_LONG_ERRNOS:
+                    # A packet too large for the receive buffer, skip it.
+                    continue
+
+                # Out of time, or a socket error likely to repeat: the pending nodes
+                # count as failed.
+                break
+
+            try:
+                reply.raise_for_status()
+            except ICMPError:
+                # Not an echo reply, e.g. destination unreachable reported by a gateway,
+                # so leave the request pending until it times out.
+                continue
+
+            ip_address = pending.pop((reply.id, reply.sequence), None)
+            if ip_address is not None:
+                replied.add(ip_address)
+
+        return replied
+
+
+async def ping_nodes(nodes, pinger):
+    """ Pings every node with an IP address in a single batch.
+
+    Uses the pinger to ping all nodes concurrently from this process. Falls back
+    to the system ping command, run for each node in the default executor, when
+    there is no pinger.
+    Args:
+        nodes:
+            A list, containing the node objects.
+        pinger:
+            A Pinger object, or None to use the system ping command.
+    """
+    nodes = [node for node in nodes if node.ip_address is not None]
+
+    if pinger is not None:
+        replied = await pinger.ping([node.ip_address for node in nodes])
+        for node in nodes:
+            node.record_ping(node.ip_address in replied)
+        return
+
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(None, node.ping) for node in nodes))
+
+
+def resolve_names(nodes):
+    """ Sets the DNS name of every node with an IP address.
+
+    Addresses missing from the reverse DNS cache, or expired from it, are
+    resolved once each in parallel, then the nodes are named from the cache.
+    Args:
+        nodes:
+            A list, containing the node objects.
+    """
+    ip_addresses = {node.ip_address for node in nodes if node.ip_address != None}
+    with ThreadPoolExecutor(max_workers=DNS_WORKERS) as executor:
+        list(executor.map(reverse_dns, ip_addresses))
+
+    for node in nodes:
+        if node.ip_address != None:
+            node.nslookup()
+
+
+async def monitor(nodes, table):
+    """ Pings the nodes in rounds and updates the table until canceled.
+    Args:
+        nodes:
+            A list, containing the node objects.
+        table:
+            A Table object, pre-populated with the nodes.
+    """
+    loop = asyncio.get_running_loop()
+
+    if os.name == 'nt':
+        # Enables ANSI escape sequences in the Windows console.
+        os.system("")
+
+    # One ICMP socket is shared by every round, falling back to the system ping
+    # command when icmplib is not installed or the socket cannot be opened.
+    pinger = None
+    if ICMPv4Socket is not None:
+        try:
+            pinger = Pinger(timeout=2)
+        except ICMPLibError:
+            pass
+
+    start = datetime.now()
+    last_save = None
+    last_resolve = start
+    resolving = None
+    try:
+        while True:
+            await ping_nodes(nodes, pinger)
+
+            # Re-resolve names every RESOLVE_INTERVAL seconds in the background, so slow
+            # DNS never delays the pings. Only addresses whose cache entries have expired
+            # are looked up again, and update_row picks up the new names.
+            if resolving is None or resolving.done():
+                if (datetime.now() - last_resolve).total_seconds() >= RESOLVE_INTERVAL:
+                    resolving = asyncio.ensure_future(loop.run_in_executor(None, resolve_names, nodes))
+                    last_resolve = datetime.now()
+
+            for index, node in enumerate(nodes):
+                if node.ip_address is None:
+                    continue
+
+                table.update_row(node, index)
+
+            # Render once per round, for the terminal and the saved file.
+            rendered = table.render()
+
+            # Redraw the table in place on the terminal once per round
+            sys.stdout.write("\x1b[H\x1b[2J" + rendered + "\n")
+            sys.stdout.flush()
+
+            # Save at most once per SAVE_INTERVAL seconds, retrying next round if it failed.
+            now = datetime.now()
+            if last_save is None or (now - last_save).total_seconds() >= SAVE_INTERVAL:
+                if await loop.run_in_executor(None, table.save, start, now, rendered):
+                    last_save = now
+
+            await asyncio.sleep(PING_INTERVAL)
+    finally:
+        # Leave the saved table current when monitoring is canceled.
+        table.save(start, datetime.now(), table.render())
+
+        if pinger is not None:
+            pinger.close()
 
 
 if __name__ == '__main__':
     # Log in and get information of nodes connected to the device's interfaces.
-    device = Device(DEVICE_IP, DEVICE_NAME, USERNAME, PASSWORD, DEVICE_TYPE)
+    username = input("Username: ")
+    password = getpass("Password: ")
+    device = Device(DEVICE_IP, DEVICE_NAME, username, password, DEVICE_TYPE)
     
     print(f"\n-----Connecting to device-----------------------------------------------------------------------------------------\n")
-    device.connect()
+    device.connect(sessions=SSH_SESSIONS)
     print(f"\n-----Connected to device------------------------------------------------------------------------------------------\n")
     
     print(f"\n-----Collecting MAC and IP Address for attached nodes-------------------------------------------------------------\n")
-    for interface in INTERFACES:
-        device.create_attached_nodes(interface)
+    device.create_attached_nodes(INTERFACES)
     
     print(f"\n-----Disconnecting from device------------------------------------------------------------------------------------\n")
     device.disconnect()
     print(f"\n-----Disconnected from device-------------------------------------------------------------------------------------\n")
     
-    for node in device.nodes:
-        if node.ip_address != None:
-            print(f"Resolving DNS name for {node.ip_address}")
-            node.nslookup()
+    print(f"Resolving DNS names for attached nodes")
+    resolve_names(device.nodes)
 
     # Monitoring and output
     table = Table()
     table.pre_populate_table(device.nodes)
-    
-    start = datetime.now()
-    while True:
-        index = 0
-        for node in device.nodes:
-            if node.ip_address is None:
-                index += 1
-                continue
-
-            node.ping()
-
-            table.update_row(node, index)
-            table.save(start, datetime.now())
-
-            # Print monitor data to terminal
-            print(f"{node.interface}\t{node.vlan}\t{node.mac_address}\t{node.ip_address}\t{node.last_ping_successful}\t{node.response_rate}\t{node.name}")
 
-            index += 1
\ No newline at end of file
+    asyncio.run(monitor(device.nodes, table))